@@ -1,28 +1,55 @@
 #adapted with appreciation from https://github.com/jump-cellpainting/pilot-cpjump1-analysis
 
+import hashlib
+import inspect
 import os
-import random
+import tempfile
 import textwrap
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from functools import reduce
 
 import pandas as pd
 import numpy as np
 import scipy
+import joblib
 from sklearn.utils.validation import check_is_fitted
 from sklearn.utils import check_array, as_float_array
 from sklearn.base import TransformerMixin, BaseEstimator
-import kneed
-import matplotlib.pyplot as plt
-import seaborn as sns
+import numba
 
-random.seed(9000)
+_RNG = np.random.default_rng(9000)
+
+# local caches live next to this module, independent of the working directory
+_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache')
+
+# on-disk cache of loaded (and sphered) plates; cached arrays are memory-mapped back in
+_memory = joblib.Memory(location=os.path.join(_CACHE_DIR, 'joblib'), mmap_mode='r', verbose=0)
+
+
+# id(df.columns) -> (weak reference to the column index, metadata columns, featuredata columns)
+_column_cache = {}
+
+def _split_columns(df):
+    """return the metadata and featuredata columns of df, computed once per column index"""
+    columns = df.columns
+    key = id(columns)
+    cached = _column_cache.get(key)
+    if cached is None or cached[0]() is not columns:
+        metacols = [c for c in columns if c.startswith("Metadata_")]
+        featurecols = [c for c in columns if not c.startswith("Metadata")]
+        # drop the entry once the column index is garbage collected, before its id can be reused
+        cached = (weakref.ref(columns, lambda _: _column_cache.pop(key, None)), metacols, featurecols)
+        _column_cache[key] = cached
+    return cached[1], cached[2]
 
 def get_metacols(df):
     """return a list of metadata columns"""
-    return [c for c in df.columns if c.startswith("Metadata_")]
+    return list(_split_columns(df)[0])
 
 def get_featurecols(df):
     """returna  list of featuredata columns"""
-    return [c for c in df.columns if not c.startswith("Metadata")]
+    return list(_split_columns(df)[1])
 
 def get_metadata(df):
     """return dataframe of just metadata columns"""
@@ -41,6 +68,31 @@ def remove_negcon_empty_wells(df):
     )
     return df
 
+def zscore_rows(features):
+    """
+    Standardize each profile (row) to mean 0 and standard deviation 1 across features,
+    so that the dot product of two rows divided by the number of features is their
+    Pearson correlation.
+    :param features: 2D numpy array of profiles
+    :return: 2D numpy array of standardized profiles
+    """
+    features = features - features.mean(axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        features /= features.std(axis=1, keepdims=True)
+    return features
+
+def _pearson_cross(A, B):
+    """
+    Pearson correlation between every row of A and every row of B, i.e. the
+    off-diagonal block of np.corrcoef(A, B) without the within-A and within-B blocks.
+    :param A: 2D array-like of profiles
+    :param B: 2D array-like of profiles
+    :return: 2D numpy array of shape (len(A), len(B))
+    """
+    A = zscore_rows(np.asarray(A, dtype=np.float32))
+    B = zscore_rows(np.asarray(B, dtype=np.float32))
+    return np.dot(A, B.T) / A.shape[1]
+
 def percent_score(null_dist, corr_dist, how='right'):
     """
     Calculates the Percent replicating
@@ -49,20 +101,22 @@ def percent_score(null_dist, corr_dist, how='right'):
     :param how: "left", "right" or "both" for using the 5th percentile, 95th percentile or both thresholds
     :return: proportion of correlation distribution beyond the threshold
     """
+    null_dist = np.asarray(null_dist, dtype=np.float64)
+    # np.nanpercentile copies and masks the data, so only use it when there are NaNs to skip
+    percentile = np.nanpercentile if np.isnan(null_dist).any() else np.percentile
     if how == 'right':
-        perc_95 = np.nanpercentile(null_dist, 95)
+        perc_95 = percentile(null_dist, 95)
         above_threshold = corr_dist > perc_95
-        return 100 * np.mean(above_threshold.astype(float)), perc_95
+        return 100 * np.count_nonzero(above_threshold) / above_threshold.size, perc_95
     if how == 'left':
-        perc_5 = np.nanpercentile(null_dist, 5)
+        perc_5 = percentile(null_dist, 5)
         below_threshold = corr_dist < perc_5
-        return 100 * np.mean(below_threshold.astype(float)), perc_5
+        return 100 * np.count_nonzero(below_threshold) / below_threshold.size, perc_5
     if how == 'both':
-        perc_95 = np.nanpercentile(null_dist, 95)
+        perc_5, perc_95 = percentile(null_dist, [5, 95])
         above_threshold = corr_dist > perc_95
-        perc_5 = np.nanpercentile(null_dist, 5)
         below_threshold = corr_dist < perc_5
-        return 100 * np.mean(above_threshold.astype(float)) + np.mean(below_threshold.astype(float)), perc_95, perc_5
+        return 100 * np.count_nonzero(above_threshold) / above_threshold.size + np.count_nonzero(below_threshold) / below_threshold.size, perc_95, perc_5
     
 def corr_between_replicates(df, group_by_feature):
     """
@@ -72,17 +126,47 @@ def corr_between_replicates(df, group_by_feature):
     :return: list-like of correlation values
     """
     replicate_corr = []
-    replicate_grouped = df.groupby(group_by_feature)
-    for name, group in replicate_grouped:
-        group_features = get_featuredata(group)
-        corr = np.corrcoef(group_features)
-        if len(group_features) == 1:  # If there is only one replicate on a plate
+    features = zscore_rows(get_featuredata(df).to_numpy(dtype=np.float32))
+    # only constant profiles give NaN correlations, so the NaN-aware median is rarely needed
+    median = np.nanmedian if np.isnan(features).any() else np.median
+    upper_triangles = {}  # group size -> indices of each replicate pair
+    replicate_grouped = df.groupby(group_by_feature).indices
+    for name, idx in replicate_grouped.items():
+        if len(idx) == 1:  # If there is only one replicate on a plate
             replicate_corr.append(np.nan)
         else:
-            np.fill_diagonal(corr, np.nan)
-            replicate_corr.append(np.nanmedian(corr))  # median replicate correlation
+            group_features = features[idx]
+            corr = np.dot(group_features, group_features.T) / features.shape[1]
+            if len(idx) not in upper_triangles:
+                upper_triangles[len(idx)] = np.triu_indices(len(idx), 1)
+            replicate_corr.append(median(corr[upper_triangles[len(idx)]]))  # median replicate correlation
     return replicate_corr
 
+@numba.njit(parallel=True, cache=True)
+def _null_medians(features, samples):
+    """
+    Median pairwise correlation within each sample of row-standardized profiles.
+    :param features: 2D numpy array of row-standardized profiles
+    :param samples: 2D numpy array of row indices, one sample per row
+    :return: 1D numpy array of median correlation values, one per sample
+    """
+    n_samples, n_replicates = samples.shape
+    n_features = features.shape[1]
+    medians = np.empty(n_samples)
+    for s in numba.prange(n_samples):
+        # each pair is correlated once; the median matches that of the full off-diagonal
+        pair_corr = np.empty(n_replicates * (n_replicates - 1) // 2)
+        p = 0
+        for i in range(n_replicates):
+            for j in range(i + 1, n_replicates):
+                dot = 0.0
+                for f in range(n_features):
+                    dot += features[samples[s, i], f] * features[samples[s, j], f]
+                pair_corr[p] = dot / n_features
+                p += 1
+        medians[s] = np.nanmedian(pair_corr)
+    return medians
+
 def corr_between_non_replicates(df, n_samples, n_replicates, metadata_compound_name):
     """
     Null distribution between random "replicates".
@@ -92,16 +176,16 @@ def corr_between_non_replicates(df, n_samples, n_replicates, metadata_compound_n
     :param metadata_compound_name: Compound name feature
     :return: list-like of correlation values, with a  length of `n_samples`
     """
-    df.reset_index(drop=True, inplace=True)
-    null_corr = []
-    while len(null_corr) < n_samples:
-        compounds = random.choices([_ for _ in range(len(df))], k=n_replicates)
-        sample = df.loc[compounds].copy()
-        if len(sample[metadata_compound_name].unique()) == n_replicates:
-            sample_features = get_featuredata(sample)
-            corr = np.corrcoef(sample_features)
-            np.fill_diagonal(corr, np.nan)
-            null_corr.append(np.nanmedian(corr))  # median replicate correlation
+    features = zscore_rows(get_featuredata(df).to_numpy(dtype=np.float32))
+    compound_rows = list(df.groupby(metadata_compound_name).indices.values())
+    compound_sizes = np.array([len(rows) for rows in compound_rows])
+    compound_offsets = np.concatenate([[0], np.cumsum(compound_sizes)[:-1]])
+    rows = np.concatenate(compound_rows)
+    # pick n_replicates distinct compounds per sample (the smallest of random keys), then one row of each
+    compounds = np.argpartition(_RNG.random((n_samples, len(compound_rows))), n_replicates - 1, axis=1)[:, :n_replicates]
+    picks = (_RNG.random((n_samples, n_replicates)) * compound_sizes[compounds]).astype(np.int64)
+    samples = rows[compound_offsets[compounds] + picks]
+    null_corr = list(_null_medians(features, samples))  # median replicate correlation
     return null_corr
 
 def corr_between_replicates_across_plates(df, reference_df, pertcol = 'Metadata_pert_iname'):
@@ -117,8 +201,7 @@ def corr_between_replicates_across_plates(df, reference_df, pertcol = 'Metadata_
         compound_df_profiles = get_featuredata(compound_df).values
         compound_reference_df_profiles = get_featuredata(compound_reference_df).values
         try:
-            corr = np.corrcoef(compound_df_profiles, compound_reference_df_profiles)
-            corr = corr[0:len(compound_df_profiles), len(compound_df_profiles):]
+            corr = _pearson_cross(compound_df_profiles, compound_reference_df_profiles)
 
             corr_median_value = np.nanmedian(corr, axis=1)
             corr_median_value = np.nanmedian(corr_median_value)
@@ -146,8 +229,7 @@ def corr_between_non_replicates_across_plates(df, reference_df, n_samples, pertc
         compound1_df_profiles = get_featuredata(compound1_df).values
         compound2_df_profiles = get_featuredata(compound2_df).values
         try:
-            corr = np.corrcoef(compound1_df_profiles, compound2_df_profiles)
-            corr = corr[0:len(compound1_df_profiles), len(compound1_df_profiles):]
+            corr = _pearson_cross(compound1_df_profiles, compound2_df_profiles)
 
             corr_median_value = np.nanmedian(corr, axis=1)
             corr_median_value = np.nanmedian(corr_median_value)
@@ -194,8 +276,7 @@ def corr_between_compound_moa(df, metadata_moa, metadata_compound_name):
             compound1_profiles = moa_grouped.iloc[i].profiles[0]
             compound2_profiles = moa_grouped.iloc[i].profiles[1]
 
-            corr = np.corrcoef(compound1_profiles, compound2_profiles)
-            corr = corr[0:len(moa_grouped.iloc[i].profiles[0]), len(moa_grouped.iloc[i].profiles[0]):]
+            corr = _pearson_cross(compound1_profiles, compound2_profiles)
             # np.fill_diagonal(corr, np.nan)
             replicate_corr.append(np.nanmedian(corr))
 
@@ -229,18 +310,95 @@ def null_corr_between_compound_moa(df, n_samples, metadata_moa, metadata_compoun
     )
 
     while len(null_corr) < n_samples:
-        compounds = random.choices([_ for _ in range(len(replicate_grouped))], k=2)
+        compounds = _RNG.integers(0, len(replicate_grouped), size=2)
         compound1_moa = replicate_grouped.iloc[compounds[0]].Metadata_moa
         compound2_moa = replicate_grouped.iloc[compounds[1]].Metadata_moa
         if compound1_moa != compound2_moa:
             compound1_profiles = replicate_grouped.iloc[compounds[0]].profiles
             compound2_profiles = replicate_grouped.iloc[compounds[1]].profiles
-            corr = np.corrcoef(compound1_profiles, compound2_profiles)
-            corr = corr[0:len(replicate_grouped.iloc[0].profiles), len(replicate_grouped.iloc[0].profiles):]
+            corr = _pearson_cross(compound1_profiles, compound2_profiles)
             # np.fill_diagonal(corr, np.nan)
             null_corr.append(np.nanmedian(corr))  # median replicate correlation
     return null_corr
 
+def _group_sample_indices(df, metadata_common, metadata_perturbation):
+    """
+    Map each perturbation group to the row indices of each of its perturbations.
+    :param df: pandas.DataFrame
+    :param metadata_common: feature that identifies perturbation pairs
+    :param metadata_perturbation: perturbation name feature
+    :return: dict of group -> list of numpy arrays of row positions, one per perturbation
+    """
+    group_samples = {}
+    for (group, sample), rows in df.groupby([metadata_common, metadata_perturbation]).indices.items():
+        group_samples.setdefault(group, []).append(rows)
+    return group_samples
+
+def _sample_pair_medians(features_1, samples_1, features_2, samples_2):
+    """
+    Median correlation between every pair of perturbations from two groups,
+    computed from one matrix product between all profiles of both groups.
+    :param features_1: row-standardized profiles of the first modality
+    :param samples_1: list of row index arrays, one per perturbation of the first group
+    :param features_2: row-standardized profiles of the second modality
+    :param samples_2: list of row index arrays, one per perturbation of the second group
+    :return: list of median correlation values, one per perturbation pair
+    """
+    corr = np.dot(features_1[np.concatenate(samples_1)], features_2[np.concatenate(samples_2)].T) / features_1.shape[1]
+    splits_1 = np.cumsum([len(rows) for rows in samples_1])[:-1]
+    splits_2 = np.cumsum([len(rows) for rows in samples_2])[:-1]
+    medians = []
+    for sample_1_corr in np.split(corr, splits_1, axis=0):
+        for sample_pair_corr in np.split(sample_1_corr, splits_2, axis=1):
+            medians.append(np.nanmedian(sample_pair_corr))  # median replicate correlation
+    return medians
+
+def _csr_group_samples(group_samples):
+    """
+    Flatten a list of groups, each a list of per-perturbation row index arrays,
+    into CSR-style offset arrays that numba kernels can index.
+    :param group_samples: list (one entry per group) of lists of numpy arrays of row positions
+    :return: group offsets into the perturbations, perturbation offsets into the rows, rows
+    """
+    samples = [rows for group in group_samples for rows in group]
+    group_offsets = np.concatenate([[0], np.cumsum([len(group) for group in group_samples])]).astype(np.int64)
+    sample_offsets = np.concatenate([[0], np.cumsum([len(rows) for rows in samples])]).astype(np.int64)
+    return group_offsets, sample_offsets, np.concatenate(samples).astype(np.int64)
+
+@numba.njit(parallel=True, cache=True)
+def _null_modality_medians(features_1, group_offsets_1, sample_offsets_1, rows_1,
+                           features_2, group_offsets_2, sample_offsets_2, rows_2,
+                           group_pairs, out_offsets):
+    """
+    Median correlation between every pair of perturbations of each drawn pair of
+    groups, with groups and perturbations given in the layout of _csr_group_samples.
+    :param group_pairs: 2D numpy array of (group of modality 1, group of modality 2) draws
+    :param out_offsets: start of each draw's perturbation pairs in the output
+    :return: 1D numpy array of median correlation values
+    """
+    n_features = features_1.shape[1]
+    medians = np.empty(out_offsets[-1])
+    for p in numba.prange(group_pairs.shape[0]):
+        g1 = group_pairs[p, 0]
+        g2 = group_pairs[p, 1]
+        o = out_offsets[p]
+        for s1 in range(group_offsets_1[g1], group_offsets_1[g1 + 1]):
+            for s2 in range(group_offsets_2[g2], group_offsets_2[g2 + 1]):
+                n1 = sample_offsets_1[s1 + 1] - sample_offsets_1[s1]
+                n2 = sample_offsets_2[s2 + 1] - sample_offsets_2[s2]
+                block = np.empty(n1 * n2)
+                k = 0
+                for i in range(sample_offsets_1[s1], sample_offsets_1[s1 + 1]):
+                    for j in range(sample_offsets_2[s2], sample_offsets_2[s2 + 1]):
+                        dot = 0.0
+                        for f in range(n_features):
+                            dot += features_1[rows_1[i], f] * features_2[rows_2[j], f]
+                        block[k] = dot / n_features
+                        k += 1
+                medians[o] = np.nanmedian(block)  # median replicate correlation
+                o += 1
+    return medians
+
 def correlation_between_modalities(modality_1_df, modality_2_df, modality_1, modality_2, metadata_common, metadata_perturbation):
     """
     Compute the correlation between two different modalities.
@@ -252,30 +410,22 @@ def correlation_between_modalities(modality_1_df, modality_2_df, modality_1, mod
     :param metadata_perturbation: perturbation name feature
     :return: list-like of correlation values
     """
-    list_common_perturbation_groups = list(np.intersect1d(list(modality_1_df[metadata_common]), list(modality_2_df[metadata_common])))
+    list_common_perturbation_groups = list(np.intersect1d(modality_1_df[metadata_common].to_numpy(), modality_2_df[metadata_common].to_numpy()))
 
     merged_df = pd.concat([modality_1_df, modality_2_df], ignore_index=False, join='inner')
 
     modality_1_df = merged_df.query('Metadata_modality==@modality_1')
     modality_2_df = merged_df.query('Metadata_modality==@modality_2')
 
+    features_1 = zscore_rows(get_featuredata(modality_1_df).to_numpy(dtype=np.float32))
+    features_2 = zscore_rows(get_featuredata(modality_2_df).to_numpy(dtype=np.float32))
+    samples_1 = _group_sample_indices(modality_1_df, metadata_common, metadata_perturbation)
+    samples_2 = _group_sample_indices(modality_2_df, metadata_common, metadata_perturbation)
+
     corr_modalities = []
 
     for group in list_common_perturbation_groups:
-        modality_1_perturbation_df = modality_1_df.loc[modality_1_df[metadata_common] == group]
-        modality_2_perturbation_df = modality_2_df.loc[modality_2_df[metadata_common] == group]
-
-        for sample_1 in modality_1_perturbation_df[metadata_perturbation].unique():
-            for sample_2 in modality_2_perturbation_df[metadata_perturbation].unique():
-                modality_1_perturbation_sample_df = modality_1_perturbation_df.loc[modality_1_perturbation_df[metadata_perturbation] == sample_1]
-                modality_2_perturbation_sample_df = modality_2_perturbation_df.loc[modality_2_perturbation_df[metadata_perturbation] == sample_2]
-
-                modality_1_perturbation_profiles = get_featuredata(modality_1_perturbation_sample_df)
-                modality_2_perturbation_profiles = get_featuredata(modality_2_perturbation_sample_df)
-
-                corr = np.corrcoef(modality_1_perturbation_profiles, modality_2_perturbation_profiles)
-                corr = corr[0:len(modality_1_perturbation_profiles), len(modality_1_perturbation_profiles):]
-                corr_modalities.append(np.nanmedian(corr))  # median replicate correlation
+        corr_modalities.extend(_sample_pair_medians(features_1, samples_1[group], features_2, samples_2[group]))
 
     return corr_modalities
 
@@ -291,46 +441,44 @@ def null_correlation_between_modalities(modality_1_df, modality_2_df, modality_1
     :param n_samples: int
     :return:
     """
-    list_common_perturbation_groups = list(np.intersect1d(list(modality_1_df[metadata_common]), list(modality_2_df[metadata_common])))
+    list_common_perturbation_groups = list(np.intersect1d(modality_1_df[metadata_common].to_numpy(), modality_2_df[metadata_common].to_numpy()))
 
     merged_df = pd.concat([modality_1_df, modality_2_df], ignore_index=False, join='inner')
 
     modality_1_df = merged_df.query('Metadata_modality==@modality_1')
     modality_2_df = merged_df.query('Metadata_modality==@modality_2')
 
-    null_modalities = []
-
-    count = 0
-
-    while count < n_samples:
-        perturbations = random.choices(list_common_perturbation_groups, k=2)
-        modality_1_perturbation_df = modality_1_df.loc[modality_1_df[metadata_common] == perturbations[0]]
-        modality_2_perturbation_df = modality_2_df.loc[modality_2_df[metadata_common] == perturbations[1]]
-
-        for sample_1 in modality_1_perturbation_df[metadata_perturbation].unique():
-            for sample_2 in modality_2_perturbation_df[metadata_perturbation].unique():
-                modality_1_perturbation_sample_df = modality_1_perturbation_df.loc[modality_1_perturbation_df[metadata_perturbation] == sample_1]
-                modality_2_perturbation_sample_df = modality_2_perturbation_df.loc[modality_2_perturbation_df[metadata_perturbation] == sample_2]
-
-                modality_1_perturbation_profiles = get_featuredata(modality_1_perturbation_sample_df)
-                modality_2_perturbation_profiles = get_featuredata(modality_2_perturbation_sample_df)
-
-                corr = np.corrcoef(modality_1_perturbation_profiles, modality_2_perturbation_profiles)
-                corr = corr[0:len(modality_1_perturbation_profiles), len(modality_1_perturbation_profiles):]
-                null_modalities.append(np.nanmedian(corr))  # median replicate correlation
-        count += 1
+    features_1 = zscore_rows(get_featuredata(modality_1_df).to_numpy(dtype=np.float32))
+    features_2 = zscore_rows(get_featuredata(modality_2_df).to_numpy(dtype=np.float32))
+    samples_1 = _group_sample_indices(modality_1_df, metadata_common, metadata_perturbation)
+    samples_2 = _group_sample_indices(modality_2_df, metadata_common, metadata_perturbation)
+    # resolve each common group to its per-perturbation row indices once, in a layout numba can index
+    group_offsets_1, sample_offsets_1, rows_1 = _csr_group_samples([samples_1[group] for group in list_common_perturbation_groups])
+    group_offsets_2, sample_offsets_2, rows_2 = _csr_group_samples([samples_2[group] for group in list_common_perturbation_groups])
+
+    # draw all n_samples pairs of perturbation groups at once; each yields one value per perturbation pair
+    perturbation_pairs = _RNG.integers(0, len(list_common_perturbation_groups), size=(n_samples, 2))
+    n_pairs = np.diff(group_offsets_1)[perturbation_pairs[:, 0]] * np.diff(group_offsets_2)[perturbation_pairs[:, 1]]
+    out_offsets = np.concatenate([[0], np.cumsum(n_pairs)])
+
+    null_modalities = _null_modality_medians(
+        features_1, group_offsets_1, sample_offsets_1, rows_1,
+        features_2, group_offsets_2, sample_offsets_2, rows_2,
+        perturbation_pairs, out_offsets,
+    )
 
-    return null_modalities
+    return list(null_modalities)
 
 class ZCA_corr(BaseEstimator, TransformerMixin):
     def __init__(self, copy=False):
         self.copy = copy
 
     def estimate_regularization(self, eigenvalue):
+        import kneed
         x = [_ for _ in range(len(eigenvalue))]
         kneedle = kneed.KneeLocator(x, eigenvalue, S=1.0, curve='convex', direction='decreasing')
         reg = eigenvalue[kneedle.elbow]/10.0
-        return reg # The complex part of the eigenvalue is ignored
+        return reg
 
     def fit(self, X, y=None):
         """
@@ -342,19 +490,23 @@ class ZCA_corr(BaseEstimator, TransformerMixin):
             matrices.
         """
         X = check_array(X, accept_sparse=False, copy=self.copy, ensure_2d=True)
-        X = as_float_array(X, copy=self.copy)
+        X = as_float_array(X, copy=self.copy).astype(np.float32, copy=False)
         self.mean_ = X.mean(axis=0)
         X_ = X - self.mean_
         cov = np.dot(X_.T, X_) / (X_.shape[0] - 1)
         V = np.diag(cov)
-        df = pd.DataFrame(X_)
-        corr = np.nan_to_num(df.corr()) # replacing nan with 0 and inf with large values
-        G, T, _ = scipy.linalg.svd(corr)
-        regularization = self.estimate_regularization(T.real)
-        t = np.sqrt(T.clip(regularization))
-        t_inv = np.diag(1.0 / t)
-        v_inv = np.diag(1.0/np.sqrt(V.clip(1e-3)))
-        self.sphere_ = np.dot(np.dot(np.dot(G, t_inv), G.T), v_inv)
+        d = np.sqrt(V)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            corr = cov / np.outer(d, d)
+        np.nan_to_num(corr, copy=False) # replacing nan with 0 and inf with large values
+        T, G = scipy.linalg.eigh(corr, driver='evd')
+        T, G = T[::-1], G[:, ::-1] # eigenvalues in decreasing order
+        regularization = self.estimate_regularization(T)
+        t_rec = 1.0 / np.sqrt(T.clip(regularization))
+        v_rec = 1.0 / np.sqrt(V.clip(1e-3))
+        # G diag(t_rec) G^T diag(v_rec), with the diagonal products done by broadcasting
+        self.sphere_ = np.dot(G * t_rec, G.T)
+        self.sphere_ *= v_rec[np.newaxis, :]
         return self
 
     def transform(self, X, y=None, copy=None):
@@ -365,7 +517,7 @@ class ZCA_corr(BaseEstimator, TransformerMixin):
             The data to sphere along the features axis.
         """
         check_is_fitted(self, "mean_")
-        X = as_float_array(X, copy=self.copy)
+        X = as_float_array(X, copy=self.copy).astype(np.float32, copy=False)
         return np.dot(X - self.mean_, self.sphere_.T)
 
 def sphere_plate_zca_corr(plate):
@@ -383,8 +535,8 @@ def sphere_plate_zca_corr(plate):
     sphereer = ZCA_corr()
     dmso_df = plate.loc[plate.Metadata_control_type=="negcon"]
     # dmso_df = plate.query("Metadata_pert_type == 'control'")
-    dmso_vals = get_featuredata(dmso_df).to_numpy()
-    all_vals = get_featuredata(plate).to_numpy()
+    dmso_vals = get_featuredata(dmso_df).to_numpy(dtype=np.float32)
+    all_vals = get_featuredata(plate).to_numpy(dtype=np.float32)
     sphereer.fit(dmso_vals)
     sphereed_vals = sphereer.transform(all_vals)
     # concat with metadata columns
@@ -396,6 +548,148 @@ def sphere_plate_zca_corr(plate):
     assert combined.shape == plate.shape
     return combined
 
+def _plate_parquet_path(batch_path, plate, suffix):
+    """return the path of the cached Parquet copy of a plate's csv(.gz) profiles"""
+    csv_path = os.path.abspath(os.path.join(batch_path, plate, plate+suffix))
+    # the hash of the full path keeps plates of the same name from different batches apart
+    path_hash = hashlib.sha1(csv_path.encode()).hexdigest()[:16]
+    name = os.path.basename(csv_path).rsplit('.csv', 1)[0]
+    return os.path.join(_CACHE_DIR, 'parquet', f'{name}-{path_hash}.parquet')
+
+def _fresh_parquet_path(batch_path, plate, suffix):
+    """return the plate's Parquet copy if it exists and is not older than the csv(.gz), else None"""
+    parquet_path = _plate_parquet_path(batch_path, plate, suffix)
+    csv_path = os.path.join(batch_path, plate, plate+suffix)
+    if os.path.exists(parquet_path) and os.path.getmtime(parquet_path) >= os.path.getmtime(csv_path):
+        return parquet_path
+    return None
+
+def _load_plate(batch_path, plate, suffix, columns=None):
+    """
+    Load a plate's profiles, caching them as a zstd-compressed Parquet file
+    on first load (and whenever the csv(.gz) changes) so later loads skip
+    text parsing. If the Parquet copy cannot be written, the csv is used as is.
+    :param batch_path: path to the batch folder
+    :param plate: plate name
+    :param suffix: suffix of the plate's csv(.gz) profile file
+    :param columns: optional list of columns to load
+    :return: pandas.DataFrame
+    """
+    parquet_path = _fresh_parquet_path(batch_path, plate, suffix)
+    if parquet_path is not None:
+        return pd.read_parquet(parquet_path, columns=columns)
+    plate_df = pd.read_csv(os.path.join(batch_path, plate, plate+suffix))
+    parquet_path = _plate_parquet_path(batch_path, plate, suffix)
+    tmp_path = None
+    try:
+        os.makedirs(os.path.dirname(parquet_path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(parquet_path))
+        os.close(fd)
+        plate_df.to_parquet(tmp_path, compression='zstd', index=False)
+        # an interrupted write leaves only the temporary file behind, never a partial Parquet copy
+        os.replace(tmp_path, parquet_path)
+    except Exception:
+        # e.g. mixed-type object columns, missing pyarrow or an unwritable cache; the cache is optional
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    if columns is not None:
+        plate_df = plate_df[columns]
+    return plate_df
+
+def _common_plate_columns(batch_path, platelist, suffix):
+    """
+    Return the columns shared by all plates, in the order of the first plate,
+    read from the Parquet schemas alone. Returns None if any plate has no
+    up-to-date Parquet copy yet.
+    """
+    import pyarrow.dataset
+
+    plate_columns = []
+    for plate in platelist:
+        parquet_path = _fresh_parquet_path(batch_path, plate, suffix)
+        if parquet_path is None:
+            return None
+        plate_columns.append(pyarrow.dataset.dataset(parquet_path, format='parquet').schema.names)
+    shared = set.intersection(*[set(columns) for columns in plate_columns])
+    return [c for c in plate_columns[0] if c in shared]
+
+# joblib.Memory only hashes the cached function's own source, so the code it calls is part of the key
+_SPHERE_CODE_VERSION = hashlib.sha1(
+    ''.join(inspect.getsource(code) for code in (_load_plate, ZCA_corr, sphere_plate_zca_corr)).encode()
+).hexdigest()
+
+@_memory.cache
+def _load_and_maybe_sphere(batch_path, plate, suffix, sphere_mode, file_stamp, code_version):
+    """
+    Load a plate and sphere it if sphere_mode == 'plate', memoized on disk.
+    file_stamp identifies the version of the plate's csv(.gz) (whose Parquet copy
+    is refreshed whenever the csv changes) and code_version that of the loading
+    and sphereing code, so edited files and code are recomputed.
+    :return: featuredata as a float32 array, featuredata column names, metadata DataFrame
+    """
+    plate_df = _load_plate(batch_path, plate, suffix)
+    if sphere_mode == 'plate':
+        plate_df = sphere_plate_zca_corr(plate_df)
+    return get_featuredata(plate_df).to_numpy(dtype=np.float32), get_featurecols(plate_df), get_metadata(plate_df)
+
+def _load_plate_cached(batch_path, plate, suffix, sphere=None):
+    """
+    Load a plate, sphereing it if sphere == 'plate', reusing the result of
+    earlier calls (also from earlier sessions) for the same unchanged file.
+    The cached featuredata is memory-mapped read-only and copied into the
+    returned DataFrame, so callers may modify it in place.
+    :param batch_path: path to the batch folder
+    :param plate: plate name
+    :param suffix: suffix of the plate's csv(.gz) profile file
+    :param sphere: None or 'plate'
+    :return: pandas.DataFrame of featuredata followed by metadata columns
+    """
+    stat = os.stat(os.path.join(batch_path, plate, plate+suffix))
+    features, featurecols, metadata = _load_and_maybe_sphere(
+        batch_path, plate, suffix, sphere, (stat.st_size, stat.st_mtime_ns), _SPHERE_CODE_VERSION
+    )
+    feature_df = pd.DataFrame(np.array(features), columns=featurecols, index=metadata.index)
+    return pd.concat([feature_df, metadata], axis=1)
+
+def _load_plates(batch_path, platelist, suffix, sphere=None):
+    """
+    Load a list of plates in parallel threads, sphereing each plate if sphere == 'plate'.
+    :param batch_path: path to the batch folder
+    :param platelist: list of plate names
+    :param suffix: suffix of the plates' csv(.gz) profile files
+    :param sphere: None, 'plate' or 'batch'
+    :return: dict of plate name -> pandas.DataFrame
+    """
+    # plate-level sphering needs each plate's full feature set, otherwise only the shared columns are loaded
+    columns = None if sphere == 'plate' else _common_plate_columns(batch_path, platelist, suffix)
+    # decompression and parsing release the GIL, so plates load concurrently in threads
+    if sphere == 'plate':
+        load = lambda plate: _load_plate_cached(batch_path, plate, suffix, sphere)
+    else:
+        load = lambda plate: _load_plate(batch_path, plate, suffix, columns)
+    with ThreadPoolExecutor(max_workers=min(8, len(platelist))) as executor:
+        data_dict = dict(zip(platelist, executor.map(load, platelist)))
+    return data_dict
+
+def _concat_plates(data_dict):
+    """
+    Stack plates on their common columns (an inner join), copying the
+    featuredata once into a single contiguous array.
+    :param data_dict: dict of plate name -> pandas.DataFrame
+    :return: pandas.DataFrame of featuredata followed by metadata columns
+    """
+    plate_dfs = list(data_dict.values())
+    common_cols = reduce(pd.Index.intersection, (plate_df.columns for plate_df in plate_dfs))
+    featurecols = [c for c in common_cols if not c.startswith("Metadata")]
+    othercols = [c for c in common_cols if c.startswith("Metadata")]
+    feature_df = pd.DataFrame(
+        np.concatenate([plate_df[featurecols].to_numpy(dtype=np.float32) for plate_df in plate_dfs], axis=0),
+        columns=featurecols,
+    )
+    # metadata is stacked by pandas to keep each column's dtype
+    metadata = pd.concat([plate_df[othercols] for plate_df in plate_dfs], ignore_index=True)
+    return pd.concat([feature_df, metadata], axis=1)
+
 def calculate_percent_replicating_MOA(batch_path,plate,data_df=None):
     """
     For plates treated with the JUMP-MOA source plates, at least 
@@ -405,10 +699,9 @@ def calculate_percent_replicating_MOA(batch_path,plate,data_df=None):
     metadata_compound_name = 'Metadata_pert_iname'
     n_samples_strong = 10000
     if type(data_df)!=pd.DataFrame:
-        data_df = pd.read_csv(os.path.join(batch_path, plate,
-                                            plate+'_normalized_feature_select_negcon.csv.gz'))
-
-    data_df = sphere_plate_zca_corr(data_df)
+        data_df = _load_plate_cached(batch_path, plate, '_normalized_feature_select_negcon.csv.gz', sphere='plate')
+    else:
+        data_df = sphere_plate_zca_corr(data_df)
 
     data_df = remove_negcon_empty_wells(data_df)
 
@@ -428,14 +721,10 @@ def calculate_percent_replicating_across_plates_MOA(batch_path1,plate1,batch_pat
     metadata_compound_name = 'Metadata_pert_iname'
     n_samples_strong = 10000
 
-    data_df1 = pd.read_csv(os.path.join(batch_path1, plate1,
-                                           plate1+'_normalized_feature_select_negcon.csv.gz'))
-    data_df1 = sphere_plate_zca_corr(data_df1)
+    data_df1 = _load_plate_cached(batch_path1, plate1, '_normalized_feature_select_negcon.csv.gz', sphere='plate')
     data_df1 = remove_negcon_empty_wells(data_df1)
 
-    data_df2 = pd.read_csv(os.path.join(batch_path2, plate2,
-                                           plate2+'_normalized_feature_select_negcon.csv.gz'))
-    data_df2 = sphere_plate_zca_corr(data_df2)
+    data_df2 = _load_plate_cached(batch_path2, plate2, '_normalized_feature_select_negcon.csv.gz', sphere='plate')
     data_df2 = remove_negcon_empty_wells(data_df2)
 
     replicate_corr = corr_between_replicates_across_plates(data_df1, data_df2)
@@ -454,10 +743,7 @@ def calculate_percent_matching_MOA(batch_path,plate):
     metadata_moa_name = 'Metadata_moa'
     metadata_compound_name = 'Metadata_pert_iname'
     n_samples_strong = 10000
-    data_df = pd.read_csv(os.path.join(batch_path, plate,
-                                           plate+'_normalized_feature_select_negcon.csv.gz'))
-
-    data_df = sphere_plate_zca_corr(data_df)
+    data_df = _load_plate_cached(batch_path, plate, '_normalized_feature_select_negcon.csv.gz', sphere='plate')
 
     data_df = remove_negcon_empty_wells(data_df)
 
@@ -487,18 +773,9 @@ suffix = '_normalized_feature_select_negcon.csv.gz',n_replicates=4):
     metadata_compound_name = 'Metadata_broad_sample'
     n_samples_strong = 10000
 
-    data_dict = {}
+    data_dict = _load_plates(batch_path, platelist, suffix, sphere)
 
-    for plate in platelist:
-        plate_df = pd.read_csv(os.path.join(batch_path, plate,
-                                            plate+suffix))
-        
-        if sphere == 'plate':
-            plate_df = sphere_plate_zca_corr(plate_df)
-
-        data_dict[plate] = plate_df
-    
-    data_df = pd.concat(data_dict, join='inner', ignore_index=True)
+    data_df = _concat_plates(data_dict)
 
     if sphere == 'batch':
         data_df = sphere_plate_zca_corr(data_df)
@@ -519,12 +796,10 @@ def calculate_percent_replicating_across_plates_Target(batch_path1,plate1,batch_
     metadata_compound_name = 'Metadata_broad_sample'
     n_samples_strong = 10000
 
-    data_df1 = pd.read_csv(os.path.join(batch_path1, plate1,
-                                           plate1+'_normalized_feature_select_negcon.csv.gz'))
+    data_df1 = _load_plate(batch_path1, plate1, '_normalized_feature_select_negcon.csv.gz')
     data_df1 = remove_negcon_empty_wells(data_df1)
 
-    data_df2 = pd.read_csv(os.path.join(batch_path2, plate2,
-                                           plate2+'_normalized_feature_select_negcon.csv.gz'))
+    data_df2 = _load_plate(batch_path2, plate2, '_normalized_feature_select_negcon.csv.gz')
     data_df2 = remove_negcon_empty_wells(data_df2)
 
     replicate_corr = corr_between_replicates_across_plates(data_df1, data_df2,pertcol=metadata_compound_name)
@@ -545,15 +820,8 @@ sphere=None,suffix = '_normalized_feature_select_negcon.csv.gz'):
     """
     n_samples = 10000
 
-    data_dict_1 = {}
-    for plate in platelist_1:
-        plate_df = pd.read_csv(os.path.join(batch_path_1, plate,
-                                            plate+suffix))
-        if sphere == 'plate':
-            plate_df = sphere_plate_zca_corr(plate_df)
-
-        data_dict_1[plate] = plate_df   
-    data_df_1 = pd.concat(data_dict_1, join='inner', ignore_index=True)
+    data_dict_1 = _load_plates(batch_path_1, platelist_1, suffix, sphere)
+    data_df_1 = _concat_plates(data_dict_1)
     if modality_1 =='Compounds':
         data_df_1.rename(columns={'Metadata_target':'Metadata_genes'},inplace=True)
     data_df_1['Metadata_modality'] = modality_1
@@ -561,15 +829,8 @@ sphere=None,suffix = '_normalized_feature_select_negcon.csv.gz'):
         data_df_1 = sphere_plate_zca_corr(data_df_1)
     data_df_1 = remove_negcon_empty_wells(data_df_1)
 
-    data_dict_2 = {}
-    for plate in platelist_2:
-        plate_df = pd.read_csv(os.path.join(batch_path_2, plate,
-                                            plate+suffix))
-        if sphere == 'plate':
-            plate_df = sphere_plate_zca_corr(plate_df)
-
-        data_dict_2[plate] = plate_df   
-    data_df_2 = pd.concat(data_dict_2, join='inner', ignore_index=True)
+    data_dict_2 = _load_plates(batch_path_2, platelist_2, suffix, sphere)
+    data_df_2 = _concat_plates(data_dict_2)
     if modality_2 =='Compounds':
         data_df_2.rename(columns={'Metadata_target':'Metadata_genes'},inplace=True)
     data_df_2['Metadata_modality'] = modality_2
@@ -598,8 +859,7 @@ sphere=None,suffix = '_normalized_negcon.csv.gz',drop='AGP'):
 
     data_dict_1 = {}
     for plate in platelist_1:
-        plate_df = pd.read_csv(os.path.join(batch_path_1, plate,
-                                            plate+suffix))
+        plate_df = _load_plate(batch_path_1, plate, suffix)
         cols_to_drop = [x for x in plate_df.columns if drop in x]
         plate_df.drop(columns=cols_to_drop,inplace=True)
         feature_select_features = pycytominer.cyto_utils.infer_cp_features(
@@ -615,7 +875,7 @@ sphere=None,suffix = '_normalized_negcon.csv.gz',drop='AGP'):
             plate_df = sphere_plate_zca_corr(plate_df)
 
         data_dict_1[plate] = plate_df   
-    data_df_1 = pd.concat(data_dict_1, join='inner', ignore_index=True)
+    data_df_1 = _concat_plates(data_dict_1)
     if modality_1 =='Compounds':
         data_df_1.rename(columns={'Metadata_target':'Metadata_genes'},inplace=True)
     data_df_1['Metadata_modality'] = modality_1
@@ -625,8 +885,7 @@ sphere=None,suffix = '_normalized_negcon.csv.gz',drop='AGP'):
 
     data_dict_2 = {}
     for plate in platelist_2:
-        plate_df = pd.read_csv(os.path.join(batch_path_1, plate,
-                                            plate+suffix))
+        plate_df = _load_plate(batch_path_1, plate, suffix)
         cols_to_drop = [x for x in plate_df.columns if drop in x]
         plate_df.drop(columns=cols_to_drop,inplace=True)
         feature_select_features = pycytominer.cyto_utils.infer_cp_features(
@@ -642,7 +901,7 @@ sphere=None,suffix = '_normalized_negcon.csv.gz',drop='AGP'):
             plate_df = sphere_plate_zca_corr(plate_df)
 
         data_dict_2[plate] = plate_df   
-    data_df_2 = pd.concat(data_dict_2, join='inner', ignore_index=True)
+    data_df_2 = _concat_plates(data_dict_2)
     if modality_2 =='Compounds':
         data_df_2.rename(columns={'Metadata_target':'Metadata_genes'},inplace=True)
     data_df_2['Metadata_modality'] = modality_2
@@ -660,6 +919,8 @@ sphere=None,suffix = '_normalized_negcon.csv.gz',drop='AGP'):
 def plot_simple_comparison(df,x,hue,y='Percent Replicating',order=None,hue_order=None,
 col=None, col_order=None, col_wrap=None,row=None,row_order=None,jitter=0.25,dodge=True,plotname=None,
 ylim=None, title=None,aspect=1,sharex=True,facet_kws={}):
+    import matplotlib.pyplot as plt
+    import seaborn as sns
     plt.rcParams["legend.markerscale"] =1.5
     sns.set_style("ticks")
     sns.set_context("paper",font_scale=1.5)
@@ -704,6 +965,8 @@ ylim=None, title=None,aspect=1,sharex=True,facet_kws={}):
 def plot_two_comparisons(df,x='Percent Replicating',y='Percent Matching',hue = None, hue_order=None,
 col=None, col_order=None,col_wrap=None,row=None,row_order=None,style=None,xlim=None,ylim=None,title=None,
 title_variable = None, facet_kws={'sharex':True}):
+    import matplotlib.pyplot as plt
+    import seaborn as sns
     plt.rcParams["legend.markerscale"] =1.5
     sns.set_style("ticks")
     sns.set_context("paper",font_scale=1.5)